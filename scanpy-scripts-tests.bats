@@ -14,6 +14,15 @@ setup() {
     read_obj="${output_dir}/read.h5ad"
     filter_opt="-p n_genes 200 2500 -p c:n_counts 0 50000 -p n_cells 3 inf -p pct_counts_mito 0 0.2 -c mito '!True' --show-obj stdout"
     filter_obj="${output_dir}/filter.h5ad"
+    filter_negated_opt="-c groupby_with_singlet cluster1,cluster2 -c groupby_with_singlet '!cluster1'"
+    filter_negated_obj="${output_dir}/filter_negated.h5ad"
+    filter_counts_opt="-p n_genes 200 2500"
+    filter_counts_obj="${output_dir}/filter_counts.h5ad"
+    filter_empty_subset="${output_dir}/empty_subset.txt"
+    filter_empty_subset_opt="-s groupby_with_singlet ${filter_empty_subset}"
+    filter_empty_subset_obj="${output_dir}/filter_empty_subset.h5ad"
+    filter_top_zero_opt="-p pct_counts_in_top_0_genes 0 1"
+    filter_top_zero_obj="${output_dir}/filter_top_zero.h5ad"
     norm_mtx="${output_dir}/norm"
     norm_opt="-r yes -t 10000 -l all -n after -X ${norm_mtx} --show-obj stdout"
     norm_obj="${output_dir}/norm.h5ad"
@@ -148,6 +157,53 @@ setup() {
     [ -f  "$filter_obj" ]
 }
 
+@test "Filter on a negated category combined with another on the same column" {
+    run rm -f $filter_negated_obj && eval "$scanpy filter $filter_negated_opt $read_obj $filter_negated_obj"
+
+    [ "$status" -eq 0 ]
+    [ -f  "$filter_negated_obj" ]
+
+    run python -c "import anndata; adata = anndata.read_h5ad('$filter_negated_obj'); assert set(adata.obs['groupby_with_singlet']) == {'cluster2'}"
+
+    [ "$status" -eq 0 ]
+}
+
+@test "Filter writes only the count columns when no QC metric is needed" {
+    run rm -f $filter_counts_obj && eval "$scanpy filter $filter_counts_opt $read_obj $filter_counts_obj"
+
+    [ "$status" -eq 0 ]
+    [ -f  "$filter_counts_obj" ]
+
+    run python -c "import anndata; adata = anndata.read_h5ad('$filter_counts_obj'); assert {'n_counts', 'n_genes'} <= set(adata.obs) and {'n_counts', 'n_cells'} <= set(adata.var); assert not {'total_counts', 'n_genes_by_counts', 'mean_counts', 'pct_dropout_by_counts'} & (set(adata.obs) | set(adata.var))"
+
+    [ "$status" -eq 0 ]
+}
+
+@test "Filter does not flag mito genes unless a condition refers to them" {
+    run python -c "import anndata; adata = anndata.read_h5ad('$filter_counts_obj'); assert 'mito' not in adata.var"
+
+    [ "$status" -eq 0 ]
+}
+
+@test "Filter with an empty subset file keeps no cells" {
+    run rm -f $filter_empty_subset_obj && eval ": > $filter_empty_subset && $scanpy filter $filter_empty_subset_opt $read_obj $filter_empty_subset_obj"
+
+    [ "$status" -eq 0 ]
+    [ -f  "$filter_empty_subset_obj" ]
+
+    run python -c "import anndata; adata = anndata.read_h5ad('$filter_empty_subset_obj'); assert adata.n_obs == 0"
+
+    [ "$status" -eq 0 ]
+}
+
+@test "Filter rejects a top-gene percentage over zero genes" {
+    run rm -f $filter_top_zero_obj && eval "$scanpy filter $filter_top_zero_opt $read_obj $filter_top_zero_obj"
+
+    [ "$status" -ne 0 ]
+    [[ "$output" == *"requires at least one top gene"* ]]
+    [ ! -f  "$filter_top_zero_obj" ]
+}
+
 # Normalise
 
 @test "Normalise expression values per cell" {
@@ -2,7 +2,10 @@
 Provide helper functions for command line parsing with click
 """
 
+import functools
+import re
 import click
+import numpy as np
 
 
 class NaturalOrderGroup(click.Group):
@@ -21,6 +24,35 @@ class NaturalOrderGroup(click.Group):
         return self.commands.keys()
 
 
+def _split_text(value):
+    return value.split(',')
+
+
+def _split_int(value):
+    tokens = value.split(',')
+    try:
+        return np.array(tokens, dtype=np.int64).tolist()
+    except OverflowError:
+        # Beyond int64, Python ints are unbounded
+        return list(map(int, tokens))
+
+
+def _split_float(value):
+    return np.array(value.split(','), dtype=np.float64).tolist()
+
+
+# Whole-string converters for common dtypes, used in place of the per-element
+# map() in CommaSeparatedText.convert()
+_FAST_CONVERTERS = {
+    click.STRING: _split_text,
+    str: _split_text,
+    click.INT: _split_int,
+    int: _split_int,
+    click.FLOAT: _split_float,
+    float: _split_float,
+}
+
+
 class CommaSeparatedText(click.ParamType):
     """
     Comma separated text
@@ -28,6 +60,7 @@ class CommaSeparatedText(click.ParamType):
     def __init__(self, dtype=click.STRING, simplify=False, length=None):
         self.dtype = dtype
         self.dtype_name = _get_type_name(dtype)
+        self._convert_fast = _FAST_CONVERTERS.get(dtype)
         self.simplify = simplify
         self.length = length
         if length and length <= 3:
@@ -40,7 +73,10 @@ class CommaSeparatedText(click.ParamType):
             if value is None:
                 converted = None
             else:
-                converted = list(map(self.dtype, str(value).split(',')))
+                if self._convert_fast:
+                    converted = self._convert_fast(str(value))
+                else:
+                    converted = list(map(self.dtype, str(value).split(',')))
                 if self.simplify and len(converted) == 1:
                     converted = converted[0]
         except ValueError:
@@ -61,6 +97,12 @@ class CommaSeparatedText(click.ParamType):
         return converted
 
 
+# A whole TEXT:VAL[,TEXT:VAL...] definition, and its individual items. Values
+# may contain ":", keys may not.
+_DICT_PATTERN = re.compile(r'[^,:]+:[^,]*(?:,[^,:]+:[^,]*)*')
+_DICT_ITEM_PATTERN = re.compile(r'([^,:]+):([^,]*)')
+
+
 class Dictionary(click.ParamType):
     """
     Text to be parsed as a python dict definition
@@ -70,35 +112,31 @@ class Dictionary(click.ParamType):
         self.keys = keys
 
     def convert(self, value, param, ctx):
-        try:
-            converted = dict()
-            for token in value.split(','):
-                if ':' not in token:
-                    raise ValueError
-                key, _, value = token.partition(':')
-                if not key:
-                    raise ValueError
-                if isinstance(self.keys, (list, tuple)) and key not in self.keys:
-                    self.fail(f'{key} is not a valid key ({self.keys})')
-                if value == 'None':
-                    value = None
-                elif value.lower() == 'true':
-                    value = True
-                elif value.lower() == 'false':
-                    value = False
-                else:
-                    try:
-                        value = float(value)
-                    except ValueError:
-                        pass
-                converted[key] = value
-            return converted
-        except ValueError:
+        if not _DICT_PATTERN.fullmatch(value):
             self.fail(
                 f'{value} is not a valid python dict definition',
                 param,
                 ctx
             )
+        converted = dict()
+        for key, val in _DICT_ITEM_PATTERN.findall(value):
+            if isinstance(self.keys, (list, tuple)) and key not in self.keys:
+                self.fail(f'{key} is not a valid key ({self.keys})')
+            converted[key] = _cast_dict_value(val)
+        return converted
+
+
+def _cast_dict_value(value):
+    if value == 'None':
+        return None
+    if value.lower() == 'true':
+        return True
+    if value.lower() == 'false':
+        return False
+    try:
+        return float(value)
+    except ValueError:
+        return value
 
 
 def _get_type_name(obj):
@@ -125,6 +163,7 @@ def valid_parameter_limits(ctx, param, value):
     return value
 
 
+@functools.lru_cache(maxsize=None)
 def mutually_exclusive_with(param_name):
     internal_name = param_name.strip('-').replace('-', '_').lower()
     def valid_mutually_exclusive(ctx, param, value):
@@ -143,6 +182,7 @@ def mutually_exclusive_with(param_name):
     return valid_mutually_exclusive
 
 
+@functools.lru_cache(maxsize=None)
 def required_by(param_name):
     internal_name = param_name.strip('-').replace('-', '_').lower()
     def required(ctx, param, value):
@@ -151,6 +191,6 @@ def required_by(param_name):
         except KeyError:
             return value
         if other_value and not value:
-            param.type.fail('required by "{}".'.format(param_name), param, ctx,)
+            param.type.fail('required by "{}".'.format(param_name), param, ctx)
         return value
     return required
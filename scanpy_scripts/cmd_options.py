@@ -581,7 +581,9 @@ CMD_OPTIONS = {
             default='index',
             show_default=True,
             help='Name of the variable that contains gene names, used for flagging '
-            'mitochondria genes when column "mito" is absent from `.var`.',
+            'mitochondria genes when column "mito" is absent from `.var`. The '
+            'column is only added when a condition refers to "mito" or '
+            '"pct_counts_mito", or with --list-attr.',
         ),
         click.option(
             '--list-attr', '-l',
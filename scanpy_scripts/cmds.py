@@ -58,7 +58,11 @@ READ_CMD = make_subcmd(
 FILTER_CMD = make_subcmd(
     'filter',
     filter_anndata,
-    cmd_desc='Filter data based on specified conditions.',
+    cmd_desc='Filter data based on specified conditions.\n\n'
+    'Always writes n_counts and n_genes to .obs, n_counts and n_cells to '
+    '.var. Other QC metrics of sc.pp.calculate_qc_metrics() (total_counts, '
+    'n_genes_by_counts, log1p_*, mean_counts, pct_dropout_by_counts, etc.) '
+    'are only written when a condition needs them.',
     arg_desc=_IO_DESC,
 )
 
@@ -2,13 +2,23 @@
 scanpy filter
 """
 
+import io
 import logging
 import re
 import click
+import numba
 import numpy as np
+import pandas as pd
 import scanpy as sc
 
 
+# Gene metrics only provided by sc.pp.calculate_qc_metrics()
+_GENE_QC_METRICS = ('mean_counts', 'pct_dropout_by_counts')
+
+_PERCENT_TOP_PATTERN = re.compile(r'^pct_counts_in_top_(?P<n>\d+)_genes$')
+_QC_VARS_PATTERN = re.compile(r'^pct_counts_(?P<qc_var>\S+)$')
+
+
 def filter_anndata(
         adata,
         gene_name='index',
@@ -21,6 +31,10 @@ def filter_anndata(
     """
     Wrapper function for sc.pp.filter_cells() and sc.pp.filter_genes(), mainly
     for supporting arbitrary filtering
+
+    `n_counts`/`n_genes` in `.obs` and `n_counts`/`n_cells` in `.var` are
+    always written. The remaining sc.pp.calculate_qc_metrics() columns, e.g.
+    `total_counts`, are only written when a condition requires that function.
     """
     param = [] if param is None else param
     category = [] if category is None else category
@@ -31,17 +45,22 @@ def filter_anndata(
     logging.debug('--category=%s', category)
     logging.debug('--subset=%s', subset)
 
-    if 'mito' not in adata.var.keys() and gene_name:
+    mito_referenced = any(
+        name.rpartition(':')[2] in ('mito', 'pct_counts_mito')
+        for name, *_ in (*param, *category, *subset))
+    if ('mito' not in adata.var.keys() and gene_name
+            and (list_attr or mito_referenced)):
         try:
-            gene_names = getattr(adata.var, gene_name)
-            k_mito = gene_names.str.startswith('MT-')
+            gene_names = _get_column(adata.var, gene_name)
+            k_mito = np.char.startswith(
+                gene_names.to_numpy(dtype=str), 'MT-')
             if k_mito.sum() > 0:
                 adata.var['mito'] = k_mito
                 adata.var['mito'] = adata.var['mito'].astype('category')
             else:
                 logging.warning('No MT genes found, skip calculating '
                                 'expression of mitochondria genes')
-        except AttributeError:
+        except KeyError:
             logging.warning(
                 'Specified gene column [%s] not found, skip calculating '
                 'expression of mitochondria genes', gene_name)
@@ -52,101 +71,148 @@ def filter_anndata(
         return 0
 
     conditions, qc_vars, pct_top = _get_filter_conditions(
-        attributes, param, category, subset)
+        _get_attribute_sets(attributes), param, category, subset)
 
     layer = 'counts' if 'counts' in adata.layers.keys() else None
-    obs_columns = adata.obs.columns
-    for qv in qc_vars:
-        if f'pct_counts_{qv}' in obs_columns and not force_recalc:
+    if not force_recalc:
+        obs_columns = adata.obs.columns
+        present_qc = [
+            qv for qv in qc_vars if f'pct_counts_{qv}' in obs_columns]
+        present_pct = [
+            pt for pt in pct_top
+            if f'pct_counts_in_top_{pt}_genes' in obs_columns]
+        for qv in present_qc:
             logging.warning('`pct_counts_%s` exists, not overwriting '
                             'without --force-recalc', qv)
-            qc_vars.remove(qv)
-    for pt in pct_top:
-        if f'pct_counts_in_top_{pt}_genes' in obs_columns and not force_recalc:
-            logging.warning('`pct_counts_%s` exists, not overwriting '
-                            'without --force-recalc', pt)
-            pct_top.remove(pt)
-    sc.pp.calculate_qc_metrics(
-        adata, layer=layer, qc_vars=qc_vars, percent_top=pct_top, inplace=True)
-    adata.obs['n_counts'] = adata.obs['total_counts']
-    adata.obs['n_genes'] = adata.obs['n_genes_by_counts']
-    adata.var['n_counts'] = adata.var['total_counts']
-    adata.var['n_cells'] = adata.var['n_cells_by_counts']
-
-    k_cell = np.ones(len(adata.obs)).astype(bool)
-    for cond in conditions['c']['numerical']:
-        name, vmin, vmax = cond
-        attr = adata.obs[name]
-        k_cell = k_cell & (attr >= vmin) & (attr <= vmax)
-
-    for cond in conditions['c']['categorical']:
-        name, values = cond
-        attr = getattr(adata.obs, name).astype(str)
-        if values[0].startswith('!'):
-            values[0] = values[0][1:]
-            k_cell = k_cell & (~attr.isin(values))
-        else:
-            k_cell = k_cell & attr.isin(values)
-
-    k_gene = np.ones(len(adata.var)).astype(bool)
-    for cond in conditions['g']['numerical']:
-        name, vmin, vmax = cond
-        attr = adata.var[name]
-        k_gene = k_gene & (attr >= vmin) & (attr <= vmax)
-
-    for cond in conditions['g']['categorical']:
-        name, values = cond
-        attr = getattr(adata.var, name).astype(str)
-        if values[0].startswith('!'):
-            values[0] = values[0][1:]
-            k_gene = k_gene & ~(attr.isin(values))
-        else:
-            k_gene = k_gene & attr.isin(values)
-
-    adata._inplace_subset_obs(k_cell)
-    adata._inplace_subset_var(k_gene)
+        for pt in present_pct:
+            logging.warning('`pct_counts_in_top_%s_genes` exists, not '
+                            'overwriting without --force-recalc', pt)
+        qc_vars = [qv for qv in qc_vars if qv not in present_qc]
+        pct_top = [pt for pt in pct_top if pt not in present_pct]
+    gene_qc_needed = any(
+        name in _GENE_QC_METRICS
+        for name, _, _ in conditions['g']['numerical'])
+    if qc_vars or pct_top or gene_qc_needed:
+        sc.pp.calculate_qc_metrics(
+            adata, layer=layer, qc_vars=qc_vars, percent_top=pct_top,
+            inplace=True)
+        adata.obs['n_counts'] = adata.obs['total_counts']
+        adata.obs['n_genes'] = adata.obs['n_genes_by_counts']
+        adata.var['n_counts'] = adata.var['total_counts']
+        adata.var['n_cells'] = adata.var['n_cells_by_counts']
+    else:
+        _calculate_count_metrics(adata, layer)
+
+    k_cell = np.ones(len(adata.obs), dtype=bool)
+    _numerical_mask(adata.obs, conditions['c']['numerical'], k_cell)
+
+    _categorical_mask(adata.obs, conditions['c']['categorical'], k_cell)
+
+    k_gene = np.ones(len(adata.var), dtype=bool)
+    _numerical_mask(adata.var, conditions['g']['numerical'], k_gene)
+
+    _categorical_mask(adata.var, conditions['g']['categorical'], k_gene)
+
+    adata._inplace_subset_obs(np.flatnonzero(k_cell))
+    adata._inplace_subset_var(np.flatnonzero(k_gene))
 
     return adata
 
 
+def _calculate_count_metrics(adata, layer):
+    """
+    Compute the `n_counts`/`n_genes` cell and `n_counts`/`n_cells` gene
+    metrics, for when the full sc.pp.calculate_qc_metrics() is not required
+    """
+    X = adata.layers[layer] if layer else adata.X
+    nonzero = X != 0
+    adata.obs['n_counts'] = np.asarray(X.sum(axis=1)).ravel()
+    adata.obs['n_genes'] = np.asarray(nonzero.sum(axis=1)).ravel()
+    adata.var['n_counts'] = np.asarray(X.sum(axis=0)).ravel()
+    adata.var['n_cells'] = np.asarray(nonzero.sum(axis=0)).ravel()
+
+
+def _numerical_mask(df, conditions, out):
+    """
+    AND the range conditions `[name, vmin, vmax]` on columns of `df` into the
+    boolean array `out` in place
+    """
+    if not conditions:
+        return out
+    # float64 is what NumPy compares int/float columns against float bounds
+    # in, and float64 columns are passed through without a copy
+    values = tuple(
+        np.ascontiguousarray(df[name].to_numpy(dtype=np.float64))
+        for name, _, _ in conditions)
+    vmins = np.array([vmin for _, vmin, _ in conditions], dtype=np.float64)
+    vmaxs = np.array([vmax for _, _, vmax in conditions], dtype=np.float64)
+    _apply_numerical_filters(values, vmins, vmaxs, out)
+    return out
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def _apply_numerical_filters(values, vmins, vmaxs, out):
+    # One pass over the rows of the columns in `values`, stopping at the first
+    # failing condition. No fastmath, NaN must keep failing the range test.
+    for i in numba.prange(len(out)):
+        if not out[i]:
+            continue
+        for j in range(len(values)):
+            v = values[j][i]
+            if not (v >= vmins[j] and v <= vmaxs[j]):
+                out[i] = False
+                break
+
+
+def _get_column(df, name):
+    """
+    Column `name` of `df` by item lookup, which is cheaper than attribute
+    access and not shadowed by DataFrame attributes. "index" refers to the
+    index.
+    """
+    return df.index if name == 'index' else df[name]
+
+
+def _categorical_mask(df, conditions, out):
+    """
+    AND the membership conditions `(name, values)` on columns of `df` into the
+    boolean array `out` in place. Values are matched against the string form
+    of the column, and a leading "!" on the first value negates the condition.
+    An empty list of values, e.g. from an empty --subset file, matches nothing.
+    """
+    grouped = {}
+    for name, values in conditions:
+        grouped.setdefault(name, []).append(values)
+
+    for name, values_list in grouped.items():
+        attr = _get_column(df, name)
+        if attr.dtype == object:
+            # Cast first, so that None and NaN match 'None' and 'nan'
+            attr = attr.astype(str)
+        cat = pd.Categorical(attr)
+        categories = cat.categories.astype(str)
+        # The extra trailing slot is hit by code -1, i.e. missing values of
+        # non-object columns, which compare as 'nan' once cast to str
+        lut = np.ones(len(categories) + 1, dtype=bool)
+        for values in values_list:
+            if not values:
+                lut[:] = False
+                continue
+            negate = values[0].startswith('!')
+            if negate:
+                values = [values[0][1:], *values[1:]]
+            k = np.append(categories.isin(values), 'nan' in values)
+            lut &= ~k if negate else k
+        out &= lut[cat.codes]
+    return out
+
+
 def _get_attributes(adata):
     attributes = {
-        'c': {
-            'numerical': [],
-            'categorical': ['index'],
-            'bool': [],
-        },
-        'g': {
-            'numerical': [],
-            'categorical': ['index'],
-            'bool': [],
-        },
+        'c': _get_attributes_by_kind(adata.obs),
+        'g': _get_attributes_by_kind(adata.var),
     }
 
-    for attr, dtype in adata.obs.dtypes.to_dict().items():
-        typ = dtype.kind
-        if typ == 'O':
-            if dtype.name == 'category' and dtype.categories.is_boolean():
-                attributes['c']['bool'].append(attr)
-            attributes['c']['categorical'].append(attr)
-        elif typ in ('i', 'f', 'u'):
-            attributes['c']['numerical'].append(attr)
-        elif typ == 'b':
-            attributes['c']['bool'].append(attr)
-            attributes['c']['categorical'].append(attr)
-
-    for attr, dtype in adata.var.dtypes.to_dict().items():
-        typ = dtype.kind
-        if typ == 'O':
-            if dtype.name == 'category' and dtype.categories.is_boolean():
-                attributes['g']['bool'].append(attr)
-            attributes['g']['categorical'].append(attr)
-        elif typ in ('i', 'f', 'u'):
-            attributes['g']['numerical'].append(attr)
-        elif typ == 'b':
-            attributes['g']['bool'].append(attr)
-            attributes['g']['categorical'].append(attr)
-
     attributes['c']['numerical'].extend([
         'n_genes',
         'n_counts',
@@ -168,6 +234,31 @@ def _get_attributes(adata):
     return attributes
 
 
+def _get_attributes_by_kind(df):
+    dtypes = df.dtypes
+    kinds = dtypes.map(lambda dtype: dtype.kind)
+    return {
+        'numerical': dtypes.index[kinds.isin(['i', 'f', 'u'])].tolist(),
+        'categorical': ['index', *dtypes.index[kinds.isin(['O', 'b'])]],
+        'bool': [
+            attr for attr, dtype in dtypes.items()
+            if dtype.kind == 'b' or (
+                dtype.name == 'category' and dtype.categories.is_boolean())
+        ],
+    }
+
+
+def _get_attribute_sets(attributes):
+    """
+    Same structure as `attributes` with sets in place of lists, for membership
+    tests
+    """
+    return {
+        cat: {dtype: set(names) for dtype, names in attrs.items()}
+        for cat, attrs in attributes.items()
+    }
+
+
 def _attributes_exists(name, attributes, dtype):
     cond_cat = ''
     if name.startswith('c:') or name.startswith('g:'):
@@ -196,21 +287,22 @@ def _get_filter_conditions(attributes, param, category, subset):
             'bool': [],
         },
     }
-    percent_top_pattern = re.compile(r'^pct_counts_in_top_(?P<n>\d+)_genes$')
     pct_top = []
-    qc_vars_pattern = re.compile(r'^pct_counts_(?P<qc_var>\S+)$')
     qc_vars = []
 
     for name, vmin, vmax in param:
         found, cond_cat, cond_name = _attributes_exists(
             name, attributes, 'numerical')
-        pt_match = percent_top_pattern.match(cond_name)
-        qv_match = qc_vars_pattern.match(cond_name)
+        pt_match = _PERCENT_TOP_PATTERN.match(cond_name)
+        qv_match = _QC_VARS_PATTERN.match(cond_name)
         if found > 1:
             raise click.ClickException(f'Ambiguous parameter "{name}" found in '
                                        'both cell and gene table')
         if found < 1:
             if pt_match:
+                if int(pt_match['n']) < 1:
+                    raise click.ClickException(
+                        f'Parameter "{name}" requires at least one top gene')
                 pct_top.append(int(pt_match['n']))
                 cond_cat = 'c'
             elif qv_match and qv_match['qc_var'] in attributes['g']['bool']:
@@ -232,22 +324,32 @@ def _get_filter_conditions(attributes, param, category, subset):
         if found < 1:
             raise click.ClickException(f'Attribute "{name}" unavailable')
         if not isinstance(values, (list, tuple)):
-            fh = values
-            values = fh.read().rstrip().split('\n')
-            fh.close()
+            # Hash-deduplicate while streaming, keeping file order so that a
+            # leading "!" on the first line still negates the subset
+            with values as fh:
+                values = list(dict.fromkeys(
+                    line.rstrip('\n') for line in fh if line.strip()))
         conditions[cond_cat]['categorical'].append((cond_name, values))
 
     logging.debug((conditions, qc_vars, pct_top))
     return conditions, qc_vars, sorted(pct_top)
 
 
-def _repr_obj(obj, padding='  ', level=0):
+def _repr_obj(obj, padding='  ', level=0, buf=None):
+    root = buf is None
+    if root:
+        buf = io.StringIO()
     if isinstance(obj, dict):
-        obj_str = '\n'.join(['\n'.join([
-            padding * level + k + ':', _repr_obj(v, level=level+1)
-        ]) for k, v in obj.items()])
+        for i, (k, v) in enumerate(obj.items()):
+            if i:
+                buf.write('\n')
+            buf.write(padding * level + k + ':\n')
+            _repr_obj(v, padding=padding, level=level+1, buf=buf)
     elif isinstance(obj, (tuple, list, set)):
-        obj_str = '\n'.join([_repr_obj(elm, level=level) for elm in obj])
+        for i, elm in enumerate(obj):
+            if i:
+                buf.write('\n')
+            _repr_obj(elm, padding=padding, level=level, buf=buf)
     else:
-        obj_str = padding * level + repr(obj)
-    return obj_str
+        buf.write(padding * level + repr(obj))
+    return buf.getvalue() if root else None
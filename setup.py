@@ -38,6 +38,7 @@ setup(
         'packaging',
         'anndata',
         'scipy',
+        'numba',
         'matplotlib',
         'pandas',
         'h5py<3.0.0',